@@ -17,363 +17,513 @@ packages are added to the exclusions file.
 Then runs the cloc.pl command on the contents of the manifest.txt file,
 filtering out packages that have an ups/eupspkg.cfg.sh.
 
+Tags are processed in parallel. Each worker process gets its own
+lsst-build checkout directory (build-worker-N next to the lsstsw build
+directory) so that workers never share a checkout. The YAML results are
+all written to the lsstsw build directory. Tags that already have a
+complete YAML report are skipped unless --force is given. The output of
+lsst-build and cloc for each tag goes to <tag>.prepare.log and
+<tag>.cloc.log. Tags that fail are listed in failed.txt in the same
+directory.
+
+With --mirror-dir a local bare mirror of every repository in repos.yaml
+that is not excluded and does not use git LFS is created or updated
+before the tags are processed and lsst-build is pointed at the mirrors,
+so each object is only downloaded once.
+
+With --database the counts for every tag are also collected into a
+single SQLite table, counts, with one row per tag, mode and language.
+
+With --source-dirs-only only the python, src and include directories of
+each product are counted. These reports, and their logs, are written to
+the src subdirectory of the lsstsw build directory and are stored with
+mode "source" rather than "full" in the database.
+
 Obtain cloc from: https://github.com/AlDanial/cloc
+It is found on $PATH unless $CLOC_EXE is set.
 """
 
+import argparse
+import functools
+import multiprocessing
 import os
+import re
+import shutil
+import sqlite3
 import sys
 import subprocess
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from pathlib import Path
 
-# Set to the location of the cloc.pl executable
-CLOC_EXE = "/Users/timj/Downloads/cloc-1.88.pl"
-
-# We cannot guess tags so easiest to list them
-# eg in lsst_distrib git repo: git tag | grep w.
-# If non-weeklies are used, rename them as weeklies
-# once created.
-TAGS_STR = """
-w.2015.22
-w.2015.30
-w.2015.33
-w.2015.35
-w.2015.36
-w.2015.37
-w.2015.38
-w.2015.39
-w.2015.40
-w.2015.43
-w.2015.44
-w.2015.45
-w.2015.47
-w.2016.03
-w.2016.05
-w.2016.06
-w.2016.08
-w.2016.10
-w.2016.12
-w.2016.15
-w.2016.19
-w.2016.20
-w.2016.28
-w.2016.32
-w.2016.34
-w.2016.36
-w.2016.37
-w.2016.39
-w.2016.40
-w.2016.41
-w.2016.42
-w.2016.43
-w.2016.44
-w.2016.45
-w.2016.46
-w.2016.47
-w.2016.48
-w.2016.49
-w.2016.50
-w.2016.51
-w.2016.52
-w.2016.53
-w.2017.1
-w.2017.10
-w.2017.11
-w.2017.12
-w.2017.13
-w.2017.14
-w.2017.15
-w.2017.16
-w.2017.17
-w.2017.18
-w.2017.2
-w.2017.20
-w.2017.21
-w.2017.22
-w.2017.23
-w.2017.24
-w.2017.25
-w.2017.26
-w.2017.27
-w.2017.28
-w.2017.29
-w.2017.3
-w.2017.30
-w.2017.31
-w.2017.32
-w.2017.33
-w.2017.34
-w.2017.35
-w.2017.36
-w.2017.37
-w.2017.38
-w.2017.39
-w.2017.4
-w.2017.40
-w.2017.41
-w.2017.42
-w.2017.43
-w.2017.44
-w.2017.45
-w.2017.46
-w.2017.47
-w.2017.48
-w.2017.49
-w.2017.5
-w.2017.50
-w.2017.51
-w.2017.52
-w.2017.6
-w.2017.7
-w.2017.8
-w.2017.9
-w.2018.01
-w.2018.02
-w.2018.03
-w.2018.04
-w.2018.05
-w.2018.06
-w.2018.07
-w.2018.08
-w.2018.09
-w.2018.10
-w.2018.11
-w.2018.12
-w.2018.13
-w.2018.14
-w.2018.15
-w.2018.16
-w.2018.17
-w.2018.18
-w.2018.19
-w.2018.20
-w.2018.21
-w.2018.22
-w.2018.23
-w.2018.24
-w.2018.25
-w.2018.26
-w.2018.27
-w.2018.28
-w.2018.29
-w.2018.30
-w.2018.31
-w.2018.32
-w.2018.33
-w.2018.34
-w.2018.35
-w.2018.36
-w.2018.37
-w.2018.38
-w.2018.39
-w.2018.40
-w.2018.41
-w.2018.42
-w.2018.43
-w.2018.44
-w.2018.45
-w.2018.46
-w.2018.47
-w.2018.48
-w.2018.49
-w.2018.50
-w.2018.51
-w.2018.52
-w.2019.01
-w.2019.02
-w.2019.03
-w.2019.04
-w.2019.05
-w.2019.06
-w.2019.07
-w.2019.08
-w.2019.09
-w.2019.10
-w.2019.11
-w.2019.12
-w.2019.13
-w.2019.14
-w.2019.15
-w.2019.16
-w.2019.17
-w.2019.18
-w.2019.19
-w.2019.20
-w.2019.21
-w.2019.22
-w.2019.23
-w.2019.24
-w.2019.25
-w.2019.26
-w.2019.27
-w.2019.28
-w.2019.29
-w.2019.31
-w.2019.32
-w.2019.33
-w.2019.34
-w.2019.35
-w.2019.36
-w.2019.37
-w.2019.38
-w.2019.40
-w.2019.41
-w.2019.42
-w.2019.43
-w.2019.44
-w.2019.45
-w.2019.46
-w.2019.47
-w.2019.48
-w.2019.49
-w.2019.50
-w.2019.51
-w.2019.52
-w.2020.01
-w.2020.02
-w.2020.03
-w.2020.04
-w.2020.05
-w.2020.06
-w.2020.07
-w.2020.08
-w.2020.09
-w.2020.10
-w.2020.11
-w.2020.12
-w.2020.13
-w.2020.14
-w.2020.15
-w.2020.16
-w.2020.17
-w.2020.18
-w.2020.19
-w.2020.20
-w.2020.21
-w.2020.22
-w.2020.23
-w.2020.24
-w.2020.25
-w.2020.26
-w.2020.27
-w.2020.28
-w.2020.29
-w.2020.30
-w.2020.31
-w.2020.32
-w.2020.33
-w.2020.34
-w.2020.35
-w.2020.36
-w.2020.37
-w.2020.38
-w.2020.39
-w.2020.40
-w.2020.41
-w.2020.42
-w.2020.43
-w.2020.44
-w.2020.45
-w.2020.46
-w.2020.47
-w.2020.48
-w.2020.49
-w.2020.50
-w.2020.51
-w.2020.52
-w.2021.01
-w.2021.02
-w.2021.03
-w.2021.04
-w.2021.05
-w.2021.06
-w.2021.07
-w.2021.08
-w.2021.09
-w.2021.10
-w.2021.11
-w.2021.12
-w.2021.13
-w.2021.14
-w.2021.15
-w.2021.16
-"""
+import yaml
 
-# Older release tags
-OLD_TAGS_STR = """
-10.1
-10.0
-9.2
-9.1
-9.0
-8.0.0.0
-7.2.0.0
-6.2.0.0
-6.1.0.4
-6.1.0.0
-"""
+# The cloc executable. Set $CLOC_EXE to override the one found on $PATH.
+# A bare command name in $CLOC_EXE is looked up on $PATH.
+if "CLOC_EXE" in os.environ:
+    CLOC_EXE = shutil.which(os.environ["CLOC_EXE"])
+else:
+    CLOC_EXE = shutil.which("cloc") or shutil.which("cloc.pl")
 
-TAGS = [t for t in TAGS_STR.split("\n") if len(t)]
+# The tags to count are listed in etc/tags.txt.
+TAGS_FILE = Path(__file__).resolve().parent.parent / "etc" / "tags.txt"
+TAGS = [line.strip() for line in TAGS_FILE.read_text().splitlines()
+        if line.strip() and not line.startswith("#")]
 
 # The EUPS product for which we are counting lines
 PRODUCT = "lsst_distrib"
 
-# Work out where we are going to be building
-if "LSST_BUILD_DIR" not in os.environ:
-    print("lsst_build has not been setup", file=sys.stderr)
-    sys.exit(1)
+# Products that are not LSST code but are not packaged with an eupspkg
+# file so cannot be recognized automatically.
+# Consider adding ndarray (was LSST, then thirdparty).
+THIRDPARTY_EXCLUDES = frozenset({"metadetect"})
+
+# Maximum number of tags to process at once. Every worker needs its own
+# checkout of the full product so do not go overboard.
+MAX_WORKERS = min(8, os.cpu_count() or 1)
+
+# The directories within a product that hold its source code.
+SOURCE_SUBDIRS = ("python", "src", "include")
+
+# Where to keep local mirrors of the package repositories.
+DEFAULT_MIRROR_DIR = os.path.join(os.path.expanduser("~"), ".cache", "lsst-mirrors")
+
+# The checkout directory owned by this worker process.
+_worker_dir = None
+
+
+def _init_worker(dir_queue):
+    """Claim a checkout directory for the lifetime of this worker."""
+    global _worker_dir
+    _worker_dir = dir_queue.get()
+
+
+def read_exclusions(exclusions_file):
+    """Read the dependency patterns from an lsst-build exclusion map.
+
+    Each line of the map is a dependency regular expression followed by
+    the regular expression of the products that should not depend on it.
+
+    Parameters
+    ----------
+    exclusions_file : `str`
+        The lsst-build exclusion map.
+
+    Returns
+    -------
+    patterns : `list` of `re.Pattern`
+        The dependencies that are excluded from at least one product.
+    """
+    with open(exclusions_file) as fd:
+        lines = fd.read().splitlines()
+    return [re.compile(line.split()[0]) for line in lines
+            if line.strip() and not line.lstrip().startswith("#")]
+
+
+def _update_mirror(name, url, mirror):
+    """Create or update the bare mirror of a single repository."""
+    if os.path.exists(mirror):
+        print(f"Updating mirror of {name}")
+        subprocess.run(["git", "-C", mirror, "remote", "update", "--prune"], check=True)
+    else:
+        print(f"Mirroring {name} from {url}")
+        subprocess.run(["git", "clone", "--mirror", url, mirror], check=True)
+
+
+def update_mirrors(repos_file, exclusions_file, mirror_dir):
+    """Mirror the repositories lsst-build will check out.
+
+    A bare mirror of each repository is created, or brought up to date
+    if it already exists, so that the workers only ever clone and fetch
+    from local disk. Local clones share objects with the mirror through
+    hard links. Repositories in the exclusion map and those using git
+    LFS, whose objects a bare mirror does not hold, keep their original
+    URL.
+
+    Parameters
+    ----------
+    repos_file : `str`
+        The lsstsw repos.yaml file listing the repository URLs.
+    exclusions_file : `str`
+        The lsst-build exclusion map.
+    mirror_dir : `str`
+        Directory to hold the mirrors.
+
+    Returns
+    -------
+    mirror_repos_file : `str`
+        A copy of the repos.yaml file pointing at the mirrors.
+    """
+    with open(repos_file) as fd:
+        repos = yaml.safe_load(fd)
+    exclusions = read_exclusions(exclusions_file)
+
+    # An entry is either a URL or a dict with a url key.
+    to_mirror = {}
+    for name, spec in repos.items():
+        if any(pattern.match(name) for pattern in exclusions):
+            continue
+        if isinstance(spec, dict) and spec.get("lfs"):
+            continue
+        to_mirror[name] = spec["url"] if isinstance(spec, dict) else spec
+
+    os.makedirs(mirror_dir, exist_ok=True)
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = {executor.submit(_update_mirror, name, url, os.path.join(mirror_dir, f"{name}.git")): name
+                   for name, url in to_mirror.items()}
+        for future in as_completed(futures):
+            # Re-raise any failure.
+            future.result()
+
+    for name in to_mirror:
+        mirror = os.path.join(mirror_dir, f"{name}.git")
+        if isinstance(repos[name], dict):
+            repos[name]["url"] = mirror
+        else:
+            repos[name] = mirror
+
+    mirror_repos_file = os.path.join(mirror_dir, "repos.yaml")
+    with open(mirror_repos_file, "w") as fd:
+        yaml.safe_dump(repos, fd)
+    return mirror_repos_file
+
+
+def read_manifest(sources_dir, subdirs=None):
+    """Read the lsst-build manifest to work out which packages could
+    contribute to the count.
+
+    Parameters
+    ----------
+    sources_dir : `str`
+        The directory lsst-build checked the source out into.
+    subdirs : `tuple` of `str`, optional
+        If given, only these directories within each product are
+        returned rather than the whole product.
+
+    Returns
+    -------
+    products : `list` of `str`
+        The products, or product directories, that should be analyzed.
+    """
+    with open(os.path.join(sources_dir, "manifest.txt")) as fd:
+        lines = fd.read().splitlines()
+
+    # We only care about the first word
+    candidates = [line.split(" ", 1)[0] for line in lines
+                  if line and not line.startswith(("#", "BUILD"))]
+
+    products = []
+    for prod in candidates:
+        if prod in THIRDPARTY_EXCLUDES:
+            continue
+
+        # One directory listing per product rather than a stat per file
+        # of interest. Nothing to count if it was never checked out.
+        prod_dir = os.path.join(sources_dir, prod)
+        try:
+            entries = set(os.listdir(prod_dir))
+        except FileNotFoundError:
+            continue
+
+        # Do not bother to count if this product has an eupspkg file
+        if "upstream" in entries:
+            continue
+        if "ups" in entries and os.path.exists(os.path.join(prod_dir, "ups", "eupspkg.cfg.sh")):
+            continue
+
+        # This is a product we should analyze
+        if subdirs is None:
+            products.append(prod)
+        else:
+            products.extend(os.path.join(prod, d) for d in subdirs if d in entries)
+
+    return products
 
-lsst_build_exe = os.path.join(os.environ["LSST_BUILD_DIR"], "bin", "lsst-build")
-lsstsw_dir = os.path.normpath(os.path.join(os.environ["LSST_BUILD_DIR"], os.path.pardir))
-sources_dir = os.path.join(lsstsw_dir, "build")
 
-# Must be in the sources directory when we run cloc
-os.chdir(sources_dir)
+def process_tag(tag, worker_dir, lsst_build_exe, repos_file, exclusions_file, output_dir,
+                subdirs=None):
+    """Check out a tag and count the lines of code.
 
-for tag in TAGS:
-    print(f"Checking out source with git ref {tag}")
+    Parameters
+    ----------
+    tag : `str`
+        The git ref to check out.
+    worker_dir : `str`
+        The directory lsst-build should check out the source into.
+    lsst_build_exe : `str`
+        Path to the lsst-build executable.
+    repos_file : `str`
+        The repos.yaml file telling lsst-build where to clone from.
+    exclusions_file : `str`
+        The lsst-build exclusion map.
+    output_dir : `str`
+        Directory to write the YAML report to.
+    subdirs : `tuple` of `str`, optional
+        Only count these directories within each product.
+
+    Returns
+    -------
+    output_file : `str`
+        Path to the YAML report written by cloc.
+    """
+    print(f"Checking out source with git ref {tag} in {worker_dir}")
     # Run lsst_build with this ref
     # lsst_build prepare --repos repos.yaml
     #                    --exclusion-map ... build_dir product
-    subprocess.run([lsst_build_exe,
-                    "prepare",
-                    "--repos", os.path.join(lsstsw_dir, "etc", "repos.yaml"),
-                    "--exclusion-map", os.path.join(lsstsw_dir, "etc", "exclusions.txt"),
-                    "--ref", tag,
-                    sources_dir,
-                    PRODUCT
-                    ], check=True)
-
-    # Read the manifest file to work out which packages could contribute
-    # to the count.
-    with open(os.path.join(sources_dir, "manifest.txt")) as fd:
-        products = []
-        for line in fd:
-            if line.startswith("#"):
-                continue
-            if line.startswith("BUILD"):
-                continue
-            # We only care about the first word
-            prod = line.split(" ")[0]
+    # Several tags are checked out at once so each gets its own log file.
+    prepare_log = os.path.join(output_dir, f"{tag}.prepare.log")
+    with open(prepare_log, "w") as log:
+        try:
+            subprocess.run([lsst_build_exe,
+                            "prepare",
+                            "--repos", repos_file,
+                            "--exclusion-map", exclusions_file,
+                            "--ref", tag,
+                            worker_dir,
+                            PRODUCT
+                            ], check=True, stdout=log, stderr=subprocess.STDOUT)
+        except subprocess.CalledProcessError as e:
+            raise RuntimeError(f"{e} See {prepare_log}") from e
+
+    products = read_manifest(worker_dir, subdirs)
+    print(f"Found {len(products)} products for {tag}")
+
+    if not products:
+        raise RuntimeError(f"No products find with ref {tag}. Please investigate.")
+
+    # We are only interested in the line counts for Python and C++.
+    # The product list is passed on stdin to keep the command line short.
+    # cloc progress output goes to a per-tag log file. cloc must run in
+    # the sources directory since the product paths are relative.
+    output_file = os.path.join(output_dir, f"{tag}.yaml")
+    cloc_log = os.path.join(output_dir, f"{tag}.cloc.log")
+    with open(cloc_log, "w") as log:
+        try:
+            subprocess.run([CLOC_EXE,
+                            '--include-lang=Python,C++,C/C++ Header',
+                            "--yaml",
+                            f"--report-file={output_file}",
+                            "--list-file=-",
+                            ], input="\n".join(products) + "\n", text=True, check=True,
+                           stdout=log, stderr=subprocess.STDOUT, cwd=worker_dir)
+        except subprocess.CalledProcessError as e:
+            raise RuntimeError(f"{e} See {cloc_log}") from e
+    return output_file
+
+
+def have_report(output_file):
+    """Return `True` if a complete cloc report already exists."""
+    if not os.path.exists(output_file) or os.path.getsize(output_file) == 0:
+        return False
+    try:
+        with open(output_file) as fd:
+            data = yaml.safe_load(fd)
+    except yaml.YAMLError:
+        return False
+    return isinstance(data, dict) and isinstance(data.get("SUM"), dict) and "code" in data["SUM"]
+
+
+def discard_incomplete_report(output_file):
+    """Remove a report, such as one left truncated by an earlier crash,
+    that `have_report` did not accept.
+    """
+    if os.path.exists(output_file):
+        print(f"Removing incomplete report {output_file}", file=sys.stderr)
+        os.remove(output_file)
+
+
+def open_database(path):
+    """Open the database of line counts, creating it if needed.
+
+    Parameters
+    ----------
+    path : `str`
+        The SQLite database file.
+
+    Returns
+    -------
+    conn : `sqlite3.Connection`
+        Connection to the database.
+    """
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("""CREATE TABLE IF NOT EXISTS counts (
+                        tag TEXT NOT NULL,
+                        mode TEXT NOT NULL,
+                        lang TEXT NOT NULL,
+                        files INTEGER,
+                        blank INTEGER,
+                        comment INTEGER,
+                        code INTEGER,
+                        PRIMARY KEY (tag, mode, lang))""")
+    return conn
+
+
+def store_report(conn, tag, mode, output_file):
+    """Copy the counts from a cloc YAML report into the database.
+
+    One row is written per language, plus one for the SUM entry. Any
+    rows previously stored for the tag are replaced.
+
+    Parameters
+    ----------
+    conn : `sqlite3.Connection`
+        Connection to the database.
+    tag : `str`
+        The tag the report was calculated for.
+    mode : `str`
+        What was counted, either "full" or "source".
+    output_file : `str`
+        The cloc YAML report.
 
-            # Do not bother to count if this product has an eupspkg file
-            if (os.path.exists(os.path.join(sources_dir, prod, "ups", "eupspkg.cfg.sh")) or
-                    os.path.exists(os.path.join(sources_dir, prod, "upstream"))):
+    Raises
+    ------
+    ValueError
+        Raised if the report does not contain any counts.
+    """
+    with open(output_file) as fd:
+        data = yaml.safe_load(fd)
+
+    if not isinstance(data, dict):
+        raise ValueError(f"No counts found in {output_file}")
+    rows = [(tag, mode, lang,
+             counts.get("nFiles"), counts.get("blank"), counts.get("comment"), counts.get("code"))
+            for lang, counts in data.items() if lang != "header" and isinstance(counts, dict)]
+    if not rows:
+        raise ValueError(f"No counts found in {output_file}")
+    # Replace everything stored for this tag so that languages no longer
+    # in the report do not linger.
+    with conn:
+        conn.execute("DELETE FROM counts WHERE tag = ? AND mode = ?", (tag, mode))
+        conn.executemany("INSERT OR REPLACE INTO counts (tag, mode, lang, files, blank, comment, code)"
+                         " VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+
+
+def _process_tag_in_worker(tag, **kwargs):
+    """Process a tag in the checkout directory owned by this worker."""
+    return process_tag(tag, _worker_dir, **kwargs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--force", action="store_true",
+                        help="Recalculate tags that already have a report.")
+    parser.add_argument("--mirror-dir", nargs="?", const=DEFAULT_MIRROR_DIR,
+                        help="Clone from local mirrors of every repository kept in this directory"
+                        f" (default {DEFAULT_MIRROR_DIR}) rather than from the network.")
+    parser.add_argument("--source-dirs-only", action="store_true",
+                        help="Only count the {} directories of each product. Faster, but the results"
+                        " are not comparable with full counts.".format(", ".join(SOURCE_SUBDIRS)))
+    parser.add_argument("--database",
+                        help="Also record the counts for every tag in this SQLite database.")
+    args = parser.parse_args()
+
+    # Work out where we are going to be building
+    if "LSST_BUILD_DIR" not in os.environ:
+        print("lsst_build has not been setup", file=sys.stderr)
+        sys.exit(1)
+
+    lsst_build_exe = os.path.join(os.environ["LSST_BUILD_DIR"], "bin", "lsst-build")
+
+    # Check the executables now rather than after the first checkout.
+    for name, exe in ((os.environ.get("CLOC_EXE", "cloc"), CLOC_EXE), ("lsst-build", lsst_build_exe)):
+        if not exe or not os.access(exe, os.X_OK):
+            print(f"Unable to find executable {name}" + (f" (tried {exe})" if exe else ""),
+                  file=sys.stderr)
+            sys.exit(1)
+
+    lsstsw_dir = os.path.normpath(os.path.join(os.environ["LSST_BUILD_DIR"], os.path.pardir))
+    sources_dir = os.path.join(lsstsw_dir, "build")
+    repos_file = os.path.join(lsstsw_dir, "etc", "repos.yaml")
+    exclusions_file = os.path.join(lsstsw_dir, "etc", "exclusions.txt")
+
+    # Only list the failures from this run.
+    failed_file = os.path.join(sources_dir, "failed.txt")
+    if os.path.exists(failed_file):
+        os.remove(failed_file)
+
+    if args.mirror_dir:
+        repos_file = update_mirrors(repos_file, exclusions_file, args.mirror_dir)
+
+    # Source-only counts are not comparable with full counts so they are
+    # kept in their own directory, out of reach of anything reading the
+    # full reports.
+    source_only = args.source_dirs_only
+    mode = "source" if source_only else "full"
+    report_dir = os.path.join(sources_dir, "src") if source_only else sources_dir
+    os.makedirs(report_dir, exist_ok=True)
+
+    tags = TAGS
+    if not args.force:
+        tags = []
+        for tag in TAGS:
+            output_file = os.path.join(report_dir, f"{tag}.yaml")
+            if have_report(output_file):
                 continue
+            discard_incomplete_report(output_file)
+            tags.append(tag)
+        print(f"Skipping {len(TAGS) - len(tags)} tags that already have a report")
 
-            # Consider filtering out ndarray (was LSST, then thirdparty)
+    # Every worker gets a private checkout directory.
+    dir_queue = multiprocessing.Queue()
+    for i in range(MAX_WORKERS):
+        worker_dir = os.path.join(lsstsw_dir, f"build-worker-{i}")
+        os.makedirs(worker_dir, exist_ok=True)
+        dir_queue.put(worker_dir)
 
-            # This is a product we should analyze
-            products.append(prod)
+    run_tag = functools.partial(_process_tag_in_worker, lsst_build_exe=lsst_build_exe,
+                                repos_file=repos_file,
+                                exclusions_file=exclusions_file,
+                                output_dir=report_dir,
+                                subdirs=SOURCE_SUBDIRS if source_only else None)
 
-    print(f"Found {len(products)} products")
+    # A failed tag does not stop the others. The failures are recorded
+    # so that they can be retried.
+    failed = []
 
-    if not products:
-        print(f"No products find with ref {tag}. Please investigate.", file=sys.stderr)
+    # Reports from earlier runs that the database has not seen yet.
+    conn = None
+    if args.database:
+        conn = open_database(args.database)
+        stored = {row[0] for row in conn.execute("SELECT DISTINCT tag FROM counts WHERE mode = ?", (mode,))}
+        for tag in TAGS:
+            if tag not in tags and tag not in stored:
+                try:
+                    store_report(conn, tag, mode, os.path.join(report_dir, f"{tag}.yaml"))
+                except (OSError, ValueError, yaml.YAMLError, sqlite3.Error) as e:
+                    print(f"Failed to store {tag}: {e}", file=sys.stderr)
+                    failed.append(tag)
+    with ProcessPoolExecutor(max_workers=MAX_WORKERS, initializer=_init_worker,
+                             initargs=(dir_queue,)) as executor:
+        futures = {executor.submit(run_tag, tag): tag for tag in tags}
+        for future in as_completed(futures):
+            tag = futures[future]
+            exc = future.exception()
+            if exc is not None:
+                print(f"Failed to process {tag}: {exc}", file=sys.stderr)
+                failed.append(tag)
+                continue
+            output_file = future.result()
+            print(f"Wrote {output_file}")
+            if conn is not None:
+                try:
+                    store_report(conn, tag, mode, output_file)
+                except (OSError, ValueError, yaml.YAMLError, sqlite3.Error) as e:
+                    print(f"Failed to store {tag}: {e}", file=sys.stderr)
+                    failed.append(tag)
+
+    if conn is not None:
+        conn.close()
+
+    if failed:
+        with open(failed_file, "w") as fd:
+            for tag in TAGS:
+                if tag in failed:
+                    print(tag, file=fd)
+        print(f"{len(failed)} tags failed. See {failed_file}", file=sys.stderr)
         sys.exit(1)
 
-    # We are only interested in the line counts for Python and C++
-    output_file = "{}.yaml".format(tag)
-    output = subprocess.run([CLOC_EXE,
-                             '--include-lang=Python,C++,C/C++ Header',
-                             "--yaml",
-                             f"--report-file={output_file}",
-                             *products], check=True)
+
+if __name__ == "__main__":
+    main()